@@ -4,11 +4,18 @@
 # MIT license
 # (c) Peter Beerli 2025, October with help of chatgpt5
 #
-import os, random, sys, time, math
+import time
+_marks = [('python', time.perf_counter())]    # startup report, see startup_report()
+import os, random, sys, math, threading, collections, traceback
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+_marks.append(('import numpy', time.perf_counter()))
 import pyglet
 from pyglet.window import key
-from pyglet import shapes
+from pyglet import gl, shapes
+_marks.append(('import pyglet, pyglet.gl', time.perf_counter()))
+import bugsim
+_marks.append(('import bugsim', time.perf_counter()))
 
 # ---------------------------------------------------------------------
 # Config / resources
@@ -20,11 +27,22 @@ IMG_FILES = [
     'mouselemur.png',
 ]
 IMG_PATHS = [os.path.join(BASEDIR, f) for f in IMG_FILES]
+GENEALOGY_FILE = 'bugsinbox_genealogy.tre'
+GENOTYPE_FILE = 'bugsinbox_genotypes.npz'
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'bugsinbox')
+SEARCH_CACHE = os.path.join(CACHE_DIR, 'search.json')
+ASSET_VERSION = 1   # bump when the layout of the decoded-asset cache changes
+ASSET_CACHE = os.path.join(CACHE_DIR, 'assets', 'v%d-pyglet%s' % (ASSET_VERSION, pyglet.version))
 SOUND_FILE = os.path.join(BASEDIR, (sys.argv[2] if len(sys.argv) > 2 else 'bullet.wav'))
 
 # Simulation globals
-HUGE = 9999.0
 GROW, SHRINK = 100, -100
+DEMES = (1, 2, 3, 4)                        # M cycles the number of boxes
+MIGRATION = (0.0, 0.01, 0.05, 0.2, 1.0)     # per bug and second; Shift+M cycles
+WALL_COLOR, SEAM_COLOR = (252,77,51), (90,90,120)   # box edges: walls, torus seams
+ARENAS = ('rectangle',) + tuple(bugsim.ARENAS)      # O cycles the arena shape
+MUTATION = (0.0, 0.05, 0.2, 1.0)            # per lineage and second; U cycles
+MUTATION_MAX = 20000        # bitsets cost n x n/8 bytes: no tracking above this
 masterscale = 0.2
 elapsed = 0.0
 helper = False
@@ -36,9 +54,15 @@ cycles_to_chase = 10
 chaseMode = False
 procreateMode = False
 didProcreate = False
+brownian = False    # B: bugs diffuse instead of running straight
 
 # Motion tuning
 BASE_SPEED = 500.0
+DIFFUSION = 0.5     # Brownian sigma per sqrt(second), as a fraction of current_speed()
+FRAME_RATE = 60.0   # redraws per second while the bugs run; none while paused
+SIM_RATE = float(os.environ.get('BUGSINBOX_RATE', 30))  # physics steps per second;
+                    # drawing blends between steps, so 15-20 is fine for big n
+SEARCH_THREADS = int(os.environ.get('BUGSINBOX_THREADS', os.cpu_count() or 1))
 def current_speed():
     # Scale base speed by box width so large windows feel similar
     return BASE_SPEED * (population.width / 1000.0 if 'population' in globals() else 1.0)
@@ -46,6 +70,7 @@ def current_speed():
 # ---------------------------------------------------------------------
 # Window & batches
 window = pyglet.window.Window(width=1280, height=800, resizable=True, visible=True)
+_marks.append(('window', time.perf_counter()))
 try:
     window.set_vsync(False)  # optional: smoother on some Macs
 except Exception:
@@ -53,39 +78,183 @@ except Exception:
 
 ui_batch = pyglet.graphics.Batch()      # lines (box + time bar)
 sprite_batch = pyglet.graphics.Batch()  # sprites or fallback circles
+tree_batch = pyglet.graphics.Batch()    # genealogy panel
 WHITE = (255, 255, 255, 255)
 
 # Non-black background (core GL safe)
 try:
-    from pyglet import gl
     gl.glClearColor(0.05, 0.06, 0.09, 1.0)
 except Exception:
     pass
 
 # ---------------------------------------------------------------------
 # Media loading with fallbacks
+# Each image carries a pyramid of halved copies (img.levels, level 0 is the
+# image itself). A swarm draws from the level closest to, but not smaller
+# than, its on-screen size (see level_for), with GL mipmaps for the rest of
+# the way, so a 300 px beetle shown at 60 px is not sampled at full size.
+def _halve(rgba):
+    # 2x2 box filter on premultiplied alpha, so transparent edges do not darken
+    h, w = rgba.shape[0] // 2 * 2, rgba.shape[1] // 2 * 2
+    a = rgba[:h, :w].astype(np.float32)
+    a[..., :3] *= a[..., 3:] / 255.0
+    a = a.reshape(h // 2, 2, w // 2, 2, 4).mean(axis=(1, 3))
+    a[..., :3] *= 255.0 / np.maximum(a[..., 3:], 1e-3)
+    return np.clip(a + 0.5, 0, 255).astype(np.uint8)
+
+def mip_levels(img, smallest=8):
+    levels = [img]
+    rgba = np.frombuffer(img.get_image_data().get_bytes('RGBA', img.width * 4), np.uint8)
+    rgba = rgba.reshape(img.height, img.width, 4)
+    while min(rgba.shape[:2]) >= 2 * smallest:
+        rgba = _halve(rgba)
+        h, w = rgba.shape[:2]
+        lvl = pyglet.image.ImageData(w, h, 'RGBA', rgba.tobytes())
+        lvl.anchor_x, lvl.anchor_y = w // 2, h // 2
+        levels.append(lvl)
+    return levels
+
+def mipmapped_texture(img):
+    # pyglet's get_mipmapped_texture() generates the mipmaps before the upload
+    tex = img.get_texture()
+    gl.glBindTexture(tex.target, tex.id)
+    gl.glGenerateMipmap(tex.target)
+    gl.glTexParameteri(tex.target, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR_MIPMAP_LINEAR)
+    return tex
+
+def level_for(img, scale):
+    # deepest level that still has at least one texel per screen pixel
+    return min(len(img.levels) - 1, max(0, int(math.floor(math.log2(1.0 / scale))))) if scale > 0 else 0
+
+# Decoded pixels and samples are kept in ASSET_CACHE as .npy files named
+# after the source file, its size and mtime, and memory-mapped on the next
+# start instead of decoded again. Decoding, on a miss, runs on a thread pool
+# while the window is already up; attach_assets() hands each result to the
+# swarms and the sound as it arrives, until then they use stand-ins.
+def _cached(path, kind, decode):
+    st = os.stat(path)
+    cache = os.path.join(ASSET_CACHE, '%s-%d-%d.%s.npy' % (os.path.basename(path), st.st_size, st.st_mtime_ns, kind))
+    try:
+        return np.load(cache, mmap_mode='r')
+    except (OSError, ValueError):
+        pass
+    data = decode(path)
+    try:
+        os.makedirs(ASSET_CACHE, exist_ok=True)
+        tmp = '%s.%d.tmp' % (cache, os.getpid())
+        with open(tmp, 'wb') as fh:
+            np.save(fh, data)
+        os.replace(tmp, cache)
+    except OSError as e:
+        print(f"[warn] cannot cache {path}: {e}")
+    return data
+
+def _decode_rgba(path):
+    img = pyglet.image.load(path)
+    rgba = np.frombuffer(img.get_image_data().get_bytes('RGBA', img.width * 4), np.uint8)
+    return rgba.reshape(img.height, img.width, 4)
+
+def _decode_pcm(path):
+    # (channels, bits, rate) as three little-endian uint32, then the samples
+    src = pyglet.media.load(path)
+    fmt = src.audio_format
+    chunks = []
+    while True:
+        audio = src.get_audio_data(1 << 20)
+        if audio is None: break
+        chunks.append(np.frombuffer(audio.data, np.uint8, audio.length))
+    head = np.array((fmt.channels, fmt.sample_size, fmt.sample_rate), '<u4').view(np.uint8)
+    return np.concatenate([head] + chunks)
+
 def load_image_safe(path):
     try:
-        img = pyglet.image.load(path)
+        rgba = _cached(path, 'rgba', _decode_rgba)
+        h, w = rgba.shape[:2]
+        img = pyglet.image.ImageData(w, h, 'RGBA', rgba.tobytes())
         img.anchor_x = img.width // 2
         img.anchor_y = img.height // 2
+        img.levels = mip_levels(img)
         return img
     except Exception as e:
         print(f"[warn] image load failed: {path} -> {e}")
         return None
 
-IMAGES = [load_image_safe(p) for p in IMG_PATHS]
-current_img_index = 0
-
 def load_sound_safe(path):
+    # runs on the loader pool, which also keeps the slow pyglet.media import
+    # (audio driver probing) off the main thread
+    class _Samples(pyglet.media.Source):
+        # samples that are already decoded; every queueing reads them afresh
+        # through a reader of its own, so one sample serves all the voices
+        def __init__(self, data, audio_format):
+            self.audio_format = audio_format
+            self.data = data
+            self.offset = 0
+            self._duration = len(data) / audio_format.bytes_per_second
+
+        def get_queue_source(self): return _Samples(self.data, self.audio_format)
+
+        def is_precise(self): return True
+
+        def seek(self, timestamp):
+            offset = int(timestamp * self.audio_format.bytes_per_second)
+            self.offset = min(self.audio_format.align(offset), len(self.data))
+
+        def get_audio_data(self, num_bytes, compensation_time=0.0):
+            if self.offset >= len(self.data): return None
+            data = self.data[self.offset:self.offset + int(num_bytes)]
+            rate = self.audio_format.bytes_per_second
+            audio = pyglet.media.codecs.AudioData(data, len(data), self.offset / rate, len(data) / rate)
+            self.offset += len(data)
+            return audio
+
     try:
-        return pyglet.media.load(path, streaming=False)
+        pcm = _cached(path, 'pcm', _decode_pcm)
+        channels, bits, rate = (int(v) for v in pcm[:12].view('<u4'))
+        fmt = pyglet.media.codecs.AudioFormat(channels, bits, rate)
+        return _Samples(pcm[12:].tobytes(), fmt)
     except Exception as e:
         print(f"[warn] sound load failed: {path} -> {e} (muted)")
-        class _Null:
-            def play(self): pass
-        return _Null()
-sound = load_sound_safe(SOUND_FILE)
+        return None
+
+_loader = ThreadPoolExecutor(max(1, min(len(IMG_PATHS) + 1, os.cpu_count() or 1)))
+_image_jobs = [_loader.submit(load_image_safe, p) for p in IMG_PATHS]
+_sound_job = _loader.submit(load_sound_safe, SOUND_FILE)
+IMAGES = [None] * len(IMG_PATHS)    # None draws the fallback disc until loaded
+current_img_index = 0
+
+# A fixed pool of players sharing the one decoded (static) sample. update()
+# calls click() at most once per tick with the number of merges it saw; a
+# burst starts one voice per merge up to the free ones, each turned down by
+# 1/sqrt(voices) so a lone click keeps full volume and a burst does not clip.
+# With all VOICES still sounding the click is dropped rather than opening
+# another player.
+VOICES = 4
+
+class Voices:
+    def __init__(self, sample=None, polyphony=VOICES):
+        self.polyphony = polyphony
+        self.players, self.busy = [], []
+        self.attach(sample)
+
+    def attach(self, sample):
+        self.sample = sample
+        self.players = [pyglet.media.Player() for _ in range(self.polyphony)] if sample is not None else []
+        self.busy = [0.0] * len(self.players)    # clock time each voice falls silent
+
+    def click(self, count=1):
+        now = time.perf_counter()
+        free = [v for v, t in enumerate(self.busy) if t <= now]
+        free = free[:count]
+        for v in free:
+            p = self.players[v]
+            if p.source is not None:
+                p.pause(); p.next_source()      # finished sample still in the playlist
+            p.volume = 1.0 / math.sqrt(len(free))
+            p.queue(self.sample)
+            p.play()
+            self.busy[v] = now + (self.sample.duration or 0.05)
+
+sound = Voices()    # silent until the sample is loaded
 
 # ---------------------------------------------------------------------
 # Helpers
@@ -94,29 +263,118 @@ def rect(r, w, deg=0):
     if deg: w = pi * w / 180.0
     return r * cos(w), r * sin(w)
 
+rng = bugsim.make_rng()
+
+# Arena fields take tens to hundreds of ms to build, so they are built on a
+# pool of their own, off the threads that hold sim.lock, and kept per
+# (name, grid shape); attach_field() swaps a finished one in.
+_fields = {}
+_field_pool = ThreadPoolExecutor(1)
+
+def _build_field(name, shape):
+    t0 = time.perf_counter()
+    arena = _fields[name, shape] = bugsim.ARENAS[name](shape)
+    print(f"[info] arena {name}: {shape[1]}x{shape[0]} field in {1e3*(time.perf_counter() - t0):.0f} ms")
+    return arena
+
 # ---------------------------------------------------------------------
-# Population (red box) drawn with shapes.Line
+# Population (red box) drawn with shapes.Line. With several demes the box
+# is cut into that many boxes side by side (bugsim.split) and each bug
+# carries the label of the deme it lives in.
 class Population:
     def __init__(self, window):
         self.x, self.y = 100, 100
         self.width  = max(200, window.width  - 200)
         self.height = max(200, window.height - 200)
         self.start = False
+        self.size = 1.0         # relative area set by the demographic schedule
+        self.moved = False      # edges wait for the render thread
+        self.demes = DEMES[0]
+        self.migration = MIGRATION[0]
+        self.torus = False      # W: edges wrap around instead of reflecting
+        self.mutation = MUTATION[0]
+        self.arena_name = ARENAS[0]
+        self.arena = None       # bugsim.Arena fitted to the deme boxes, None for the rectangle
 
-        self._edge_top    = shapes.Line(0,0,0,0, thickness=1, batch=ui_batch)
-        self._edge_bottom = shapes.Line(0,0,0,0, thickness=1, batch=ui_batch)
-        self._edge_left   = shapes.Line(0,0,0,0, thickness=1, batch=ui_batch)
-        self._edge_right  = shapes.Line(0,0,0,0, thickness=1, batch=ui_batch)
-        for ln in (self._edge_top, self._edge_bottom, self._edge_left, self._edge_right):
-            ln.color = (252,77,51)
+        self._edges = []        # bottom, top, left, right of each deme box
+        self._walls = []        # picture of the arena walls in each deme box
+        self._field_job = None  # (name, shape) and future of a field being built
         self._sync_edges()
 
+    @property
+    def box(self): return (self.x, self.y, self.width, self.height)
+
+    @property
+    def boxes(self): return bugsim.split(self.box, self.demes)
+
+    @property
+    def period(self):
+        # (width, height) every deme wraps around on a torus, else None
+        return tuple(self.boxes[0, 2:].tolist()) if self.torus else None
+
+    def box_of(self, deme):
+        # what bugsim.move() needs: the one box, or the box of every bug
+        return self.box if self.demes == 1 else self.boxes[deme]
+
+    def place(self, pos, radius, first=0):
+        # labels for new bugs drawn in the whole box, dealt round the demes
+        # in turn, and their positions carried into their deme's box and
+        # out of the arena walls
+        deme = (first + np.arange(len(pos))) % self.demes
+        if self.demes > 1: bugsim.remap(pos, self.box, self.boxes[deme])
+        if self.arena is not None: self.arena.scatter(pos, self.box_of(deme), radius, rng)
+        return deme
+
+    def _fit_arena(self, boxes):
+        # the field stretches with the deme boxes; a new one is wanted only
+        # when their aspect has moved by more than a tenth. The arena in use
+        # stays until the pool has built it (see attach_field)
+        if self.arena_name == ARENAS[0]:
+            self._set_arena(None)
+        else:
+            shape = bugsim.grid_shape(boxes[0])
+            if (self.arena is None or self.arena.name != self.arena_name
+                    or abs(math.log(shape[0] * self.arena.shape[1] / (shape[1] * self.arena.shape[0]))) > 0.1):
+                want = (self.arena_name, shape)
+                if want in _fields:
+                    self._set_arena(_fields[want])
+                elif self._field_job is None or self._field_job[0] != want:
+                    if self._field_job is not None: self._field_job[1].cancel()
+                    self._field_job = (want, _field_pool.submit(_build_field, *want))
+                    pyglet.clock.unschedule(attach_field)
+                    pyglet.clock.schedule_interval(attach_field, 1/20.0)
+        count = len(boxes) if self.arena is not None else 0
+        while len(self._walls) < count:
+            self._walls.append(pyglet.sprite.Sprite(self._walls_img, batch=ui_batch))
+        while len(self._walls) > count:
+            self._walls.pop().delete()
+        for sp, (x, y, w, h) in zip(self._walls, boxes.tolist()):
+            sp.update(x=x, y=y, scale_x=w / sp.image.width, scale_y=h / sp.image.height)
+
+    def _set_arena(self, arena):
+        if arena is self.arena: return
+        self.arena = arena
+        for sp in self._walls: sp.delete()
+        self._walls = []
+        if arena is not None:
+            h, w = arena.shape
+            self._walls_img = pyglet.image.ImageData(w, h, 'RGBA', arena.image(WALL_COLOR).tobytes())
+
     def _sync_edges(self):
-        x, y, w, h = self.x, self.y, self.width, self.height
-        self._edge_bottom.x, self._edge_bottom.y, self._edge_bottom.x2, self._edge_bottom.y2 = x, y, x+w, y
-        self._edge_top.x,    self._edge_top.y,    self._edge_top.x2,    self._edge_top.y2    = x, y+h, x+w, y+h
-        self._edge_left.x,   self._edge_left.y,   self._edge_left.x2,   self._edge_left.y2   = x, y, x, y+h
-        self._edge_right.x,  self._edge_right.y,  self._edge_right.x2,  self._edge_right.y2  = x+w, y, x+w, y+h
+        boxes = self.boxes
+        while len(self._edges) < 4 * len(boxes):
+            self._edges.append(shapes.Line(0,0,0,0, thickness=1, batch=ui_batch))
+        while len(self._edges) > 4 * len(boxes):
+            self._edges.pop().delete()
+        for ln in self._edges:
+            ln.color = SEAM_COLOR if self.torus else WALL_COLOR
+        self._fit_arena(boxes)
+        for (x, y, w, h), k in zip(boxes.tolist(), range(0, len(self._edges), 4)):
+            bottom, top, left, right = self._edges[k:k+4]
+            bottom.x, bottom.y, bottom.x2, bottom.y2 = x, y, x+w, y
+            top.x,    top.y,    top.x2,    top.y2    = x, y+h, x+w, y+h
+            left.x,   left.y,   left.x2,   left.y2   = x, y, x, y+h
+            right.x,  right.y,  right.x2,  right.y2  = x+w, y, x+w, y+h
 
     def update(self, growvalue):
         self.width  = max(100, self.width  + growvalue)
@@ -125,84 +383,223 @@ class Population:
         self.y -= growvalue // 2
         self._sync_edges()
 
+    def set_size(self, size):
+        # shrink or grow about the centre to the relative area size
+        self.x, self.y, self.width, self.height = bugsim.resize(self.box, self.size, size)
+        self.size = size
+        self.moved = True
+
 population = Population(window)
+demography = bugsim.SCHEDULES[0]    # N cycles through bugsim.SCHEDULES
 
 # ---------------------------------------------------------------------
-# Bug: sprite with PNG, or fallback circle if PNG missing
-class Bug:
-    def __init__(self, img):
-        self.is_sprite = img is not None
-        radius_pix = masterscale * ((img.width + img.height)/4 if img else 64)
-        x0 = population.x + radius_pix/2
-        y0 = population.y + radius_pix/2
-        x = x0 + random.random() * max(1, (population.width  - radius_pix))
-        y = y0 + random.random() * max(1, (population.height - radius_pix))
-
-        if self.is_sprite:
-            self.sprite = pyglet.sprite.Sprite(img, x, y, batch=sprite_batch)
-            self.sprite.scale = masterscale
-            self.width = img.width
-            self.height= img.height
-        else:
-            r = int(max(4, radius_pix/2))
-            self.circle = shapes.Circle(x, y, r, color=(200,220,255), batch=sprite_batch)
-            self.width = self.height = 2*r
+# Swarm: all bugs of one kind. State lives in NumPy arrays (see bugsim.py)
+# and is drawn from a single vertex list, two triangles per bug, so spawning
+# n bugs is one Generator call and one allocation instead of n sprites.
+# pos/rot are the simulation's back buffer; publish() hands a copy to the
+# render thread as the front buffer, and only sync() (render thread) does GL.
+# The front buffer keeps the previous step too, and sync() draws the blend
+# of both by the fraction of the step that has passed since it was published.
+def _fallback_image(size=64):
+    # pale disc used when a PNG is missing
+    yy, xx = np.mgrid[0:size, 0:size] + 0.5
+    inside = (xx - size/2)**2 + (yy - size/2)**2 <= (size/2)**2
+    rgba = np.zeros((size, size, 4), np.uint8)
+    rgba[inside] = (200, 220, 255, 255)
+    img = pyglet.image.ImageData(size, size, 'RGBA', rgba.tobytes())
+    img.anchor_x = img.anchor_y = size // 2
+    img.levels = mip_levels(img)
+    return img
 
-        self.dx, self.dy = rect(current_speed(), random.uniform(-math.pi, math.pi), 0)
-        self.rotation = -math.degrees(math.atan2(random.random()-0.5, random.random()-0.5))
+QUAD = (0, 1, 2, 0, 2, 3)  # corners of the two triangles drawn for each bug
+
+def _attr(vlist, name, width):
+    # writable (bugs, 6, width) view on a vertex attribute; reading it marks it for upload
+    return np.ctypeslib.as_array(getattr(vlist, name)).reshape(-1, len(QUAD), width)
+
+class Swarm:
+    def __init__(self, img, scale, record=False):
+        self.scale = scale
+        self.level = 0
+        self.pos = np.empty((0, 2))
+        self.vel = np.empty((0, 2))
+        self.rot = np.empty(0)
+        self.node = np.empty(0, np.int64)    # genealogy node carried by each bug
+        self.deme = np.empty(0, np.int64)    # deme each bug lives in
+        self.record = record
+        self.genealogy = None
+        self.mutations = None                # sites on the lineages (bugsim.Mutations)
+        self.slot = np.empty(0, np.int64)    # row of each bug's lineage in mutations
+        self._vlist = None
+        self._capacity = 0
+        self._want = None                    # capacity to allocate on the render thread
+        self._drawn, self._shown = None, -1  # front buffer and count in the vertex list
+        self.front = (self.pos, self.pos, self.rot, 0.0)   # prev, pos, rot, stamp
+        self._alpha = 1.0
+        self._set_image(img)
+
+    def __len__(self): return len(self.pos)
 
     @property
-    def x(self): return self.sprite.x if self.is_sprite else self.circle.x
-    @x.setter
-    def x(self, v):
-        if self.is_sprite: self.sprite.x = v
-        else: self.circle.x = v
-    @property
-    def y(self): return self.sprite.y if self.is_sprite else self.circle.y
-    @y.setter
-    def y(self, v):
-        if self.is_sprite: self.sprite.y = v
-        else: self.circle.y = v
+    def radius(self): return self.scale * (self.width + self.height) / 4
+
+    def _set_image(self, img):
+        self.img = img if img is not None else _fallback_image()
+        self.width, self.height = self.img.width, self.img.height
+        self.level = level_for(self.img, self.scale)
+
+    def _allocate(self, capacity):
+        # one block for all quads; quads beyond len(self) are hidden with zero scale
+        if self._vlist is not None:
+            self._vlist.delete()
+            self._vlist = None
+        self._capacity = capacity
+        self._drawn, self._shown = None, -1
+        if capacity == 0: return
+        img = self.img.levels[self.level]
+        tex = mipmapped_texture(img)
+        program = pyglet.sprite.get_default_shader()
+        group = pyglet.sprite.SpriteGroup(tex, gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA, program)
+        # not indexed: pyglet fills index buffers element by element in Python
+        self._vlist = vl = program.vertex_list(
+            len(QUAD)*capacity, gl.GL_TRIANGLES, sprite_batch, group,
+            position='f', colors='Bn', translate='f', scale='f', rotation='f', tex_coords='f')
+        x1, y1 = -img.anchor_x, -img.anchor_y
+        x2, y2 = x1 + img.width, y1 + img.height
+        corners = np.array(((x1, y1, 0), (x2, y1, 0), (x2, y2, 0), (x1, y2, 0)))
+        _attr(vl, 'position', 3)[:] = corners[list(QUAD)]
+        _attr(vl, 'tex_coords', 3)[:] = np.reshape(tex.tex_coords, (4, 3))[list(QUAD)]
+        _attr(vl, 'colors', 4)[:] = 255
+        _attr(vl, 'translate', 3)[:] = 0
+
+    def publish(self, prev=None, stamp=None):
+        # simulation side: the finished step becomes the front buffer in one swap;
+        # without a matching prev the bugs jump straight to pos
+        pos = self.pos.copy()
+        if prev is None or len(prev) != len(pos): prev = pos
+        self.front = (prev, pos, self.rot.copy(), time.perf_counter() if stamp is None else stamp)
+
+    def sync(self, blend=True):
+        # render side: copy the front buffer into the vertex list
+        front = self.front
+        prev, pos, rot, stamp = front
+        n = len(pos)
+        want = self._want
+        if want is None and n > self._capacity: want = max(n, 2*self._capacity)
+        if want is not None:
+            self._want = None
+            self._allocate(want)
+        vl = self._vlist
+        alpha = min(1.0, (time.perf_counter() - stamp) / sim.dt) if blend else 1.0
+        if vl is None or (front is self._drawn and n == self._shown and alpha == self._alpha): return
+        if alpha < 1.0:
+            # a bug that wrapped around or migrated is drawn where it landed
+            # rather than flown across the box
+            d = pos - prev
+            d[np.abs(d) > 0.5 * population.boxes[0, 2:]] = 0.0
+            pos = pos - (1.0 - alpha) * d
+        _attr(vl, 'translate', 3)[:n, :, :2] = pos[:, None, :]
+        _attr(vl, 'rotation', 1)[:n, :, 0] = rot[:, None]
+        if n != self._shown:
+            s = _attr(vl, 'scale', 2)
+            s[:n] = self.scale * self.img.width / self.img.levels[self.level].width
+            s[n:] = 0.0
+            self._shown = n
+        self._drawn, self._alpha = front, alpha
+
+    def _new_nodes(self, n):
+        if self.genealogy is None: return np.full(n, -1, np.int64)
+        return self.genealogy.add_tips(n)
+
+    def _new_slots(self, nodes):
+        if self.mutations is None: return np.full(len(nodes), -1, np.int64)
+        return self.mutations.add_tips(len(nodes), nodes)
+
+    def track_mutations(self):
+        # started on demand: the lineage bitsets grow with the square of the
+        # sample, so a run without a mutation rate never pays for them
+        if self.genealogy is None or self.mutations is not None: return
+        n = len(self.genealogy.tips)
+        if n > MUTATION_MAX:
+            print(f"[info] {n} bugs: no mutations above {MUTATION_MAX}")
+            return
+        self.mutations, self.slot = bugsim.Mutations.from_genealogy(self.genealogy, self.node)
+
+    def spawn(self, n, img):
+        self._set_image(img)
+        self.pos, self.vel, self.rot = bugsim.spawn(n, population.box, self.radius, current_speed(), rng)
+        self.deme = population.place(self.pos, self.radius)
+        self.genealogy = bugsim.Genealogy(n) if self.record else None
+        self.mutations = None
+        self.node = self._new_nodes(n)
+        self.slot = self._new_slots(self.node)
+        if population.mutation: self.track_mutations()
+        self._want = n
+        self.publish()
+
+    def add(self, n=1):
+        pos, vel, rot = bugsim.spawn(n, population.box, self.radius, current_speed(), rng)
+        self.deme = np.concatenate((self.deme, population.place(pos, self.radius, len(self))))
+        self.pos = np.concatenate((self.pos, pos))
+        self.vel = np.concatenate((self.vel, vel))
+        self.rot = np.concatenate((self.rot, rot))
+        nodes = self._new_nodes(n)
+        self.node = np.concatenate((self.node, nodes))
+        self.slot = np.concatenate((self.slot, self._new_slots(nodes)))
+        self.publish()
+
+    def remove(self, i):
+        # D: unlike a bug swallowed in a merge, a removed bug takes its
+        # lineage, tips below it included, out of the sample
+        if self.genealogy is not None: self.genealogy.drop(self.node[i])
+        if self.mutations is not None: self.mutations.drop(self.slot[i])
+        self.delete(i)
+
+    def delete(self, i):
+        self.pos = np.delete(self.pos, i, axis=0)
+        self.vel = np.delete(self.vel, i, axis=0)
+        self.rot = np.delete(self.rot, i)
+        self.node = np.delete(self.node, i)
+        self.slot = np.delete(self.slot, i)
+        self.deme = np.delete(self.deme, i)
+        prev, _, _, stamp = self.front
+        self.publish(np.delete(prev, i, axis=0), stamp)
+
+    def record_merge(self, i, j, t):
+        # bug i swallows bug j: i now carries the ancestor of both lineages
+        if self.genealogy is not None:
+            self.node[i] = self.genealogy.merge(self.node[i], self.node[j], t)
+        if self.mutations is not None:
+            self.mutations.merge(self.slot[i], self.slot[j])
+
+    def set_image(self, img):
+        self._set_image(img)
+        self._want = self._capacity
 
     def setscale(self, s):
-        if self.is_sprite: self.sprite.scale = s
-        else: self.circle.radius = max(2, int(s*(self.width+self.height)/8))
+        self.scale = s
+        level = level_for(self.img, s)
+        if level != self.level:
+            self.level = level
+            self._want = self._capacity       # new texture: rebuilt on the render thread
+        self._shown = -1
 
-    def changebug(self, new_img):
-        if new_img is None: return
-        if self.is_sprite:
-            self.sprite.image = new_img
-        else:
-            self.is_sprite = True
-            self.sprite = pyglet.sprite.Sprite(new_img, self.x, self.y, batch=sprite_batch)
-            self.circle.delete()
-        new_img.anchor_x = new_img.width // 2
-        new_img.anchor_y = new_img.height // 2
-        self.width, self.height = new_img.width, new_img.height
-
-    def turn(self, minAngle, maxAngle):
-        angle = random.uniform(minAngle, maxAngle) if minAngle != maxAngle else minAngle
-        self.dx, self.dy = rect(current_speed(), angle, 0)
-        self.rotation = -math.degrees(math.atan2(random.random()-0.5, random.random()-0.5))
-
-    def update(self, dt):
-        if not population.start: return (self.x, self.y)
-        radius = masterscale * (self.width + self.height)/4
-        x0 = population.x + radius/2
-        y0 = population.y + radius/2
-        if self.x <= x0 or self.x >= (x0 + population.width - radius):  self.dx *= -1.0
-        if self.y <= y0 or self.y >= (y0 + population.height - radius): self.dy *= -1.0
-        oldx, oldy = self.x, self.y
-        # clamp, then move, then clamp again
-        self.x = min(max(self.x, x0), x0 + population.width  - radius)
-        self.y = min(max(self.y, y0), y0 + population.height - radius)
-        self.x += self.dx * dt
-        self.y += self.dy * dt
-        self.x = min(max(self.x, x0), x0 + population.width  - radius)
-        self.y = min(max(self.y, y0), y0 + population.height - radius)
-        if self.is_sprite:
-            self.sprite.rotation = -math.degrees(math.atan2(oldy-self.y, oldx-self.x))
-        return (self.x, self.y)
+    def turn(self, i, minAngle, maxAngle):
+        angle = rng.uniform(minAngle, maxAngle) if minAngle != maxAngle else minAngle
+        self.vel[i] = rect(current_speed(), angle, 0)
+
+    def update(self, dt, sel=slice(None)):
+        if not population.start: return self.pos
+        if len(self):
+            box = population.box_of(self.deme[sel])
+            if brownian:
+                self.rot[sel] = bugsim.diffuse(self.pos[sel], dt, box, self.radius, DIFFUSION * current_speed(),
+                                               rng, population.torus, population.arena)
+            else:
+                self.rot[sel] = bugsim.move(self.pos[sel], self.vel[sel], dt, box, self.radius,
+                                            population.torus, population.arena)
+            self.publish(self.front[1])
+        return self.pos
 
 # ---------------------------------------------------------------------
 # Labels
@@ -213,6 +610,10 @@ label2  = pyglet.text.Label("k: 0", font_size=12, color=WHITE,
                             x=window.width - window.width//8,
                             y=window.height - window.height//15,
                             anchor_x='center')
+label4  = pyglet.text.Label("", font_size=10, color=(255, 200, 80, 255),
+                            x=window.width - window.width//8,
+                            y=window.height - window.height//15 - 20,
+                            anchor_x='center')
 label3  = pyglet.text.Label("Time: 0", font_size=12, multiline=True, width=200, color=WHITE,
                             x=window.width//5, y=window.height - window.height//20, anchor_x='center')
 helplabel = pyglet.text.Label("", font_size=12, multiline=True, width=800, color=WHITE,
@@ -233,45 +634,163 @@ def displayhelp():
     te += "Z         cute mode (mouse lemur)\n"
     te += "C         chase mode\n"
     te += "P         procreate mode\n"
+    te += "B         Brownian motion instead of straight runs\n"
+    te += "W         wrap around the edges (torus) instead of bouncing off walls\n"
+    te += "O         arena shape: " + ", ".join(ARENAS) + "\n"
+    te += "M         number of boxes (demes): 1-4; Shift+M migration rate between them\n"
+    te += "N         demographic schedule: " + ", ".join(d.name for d in bugsim.SCHEDULES) + "\n"
+    te += "K         overlay/remove an exact Kingman sample in the time bar\n"
+    te += "T         show/hide the genealogy panel\n"
+    te += "G         save genealogy (Newick) to " + GENEALOGY_FILE + "\n"
+    te += "U         mutation rate per lineage: " + ", ".join(map(str, MUTATION)) + "\n"
+    te += "X         save the bit-packed genotype matrix to " + GENOTYPE_FILE + "\n"
     return te
 
 # ---------------------------------------------------------------------
-# Time bar (optimized with dirty flag)
-_time_tick_lines, _time_box_lines = [], []
+# Time bar (optimized with dirty flag): frame, event ticks and Kingman
+# ticks are segments of one GL_LINES vertex list. A new event or a resize
+# rewrites the segment array in place (every tick moves when the last event
+# moves), nothing is deleted and created again; capacity doubles as needed.
 timebar_dirty = True
+kingman_times = None    # analytic sample overlaid in the lower half of the bar (K)
+BAR_COLOR, TICK_COLOR, KINGMAN_COLOR = (252, 77, 51, 255), (40, 40, 255, 255), (60, 200, 120, 255)
+_timebar = {'vlist': None, 'capacity': 0}
 
-def _clear_time_lines():
-    for ln in _time_tick_lines: ln.delete()
-    _time_tick_lines.clear()
-    for ln in _time_box_lines: ln.delete()
-    _time_box_lines.clear()
+def _timebar_vlist(segments):
+    if segments > _timebar['capacity']:
+        if _timebar['vlist'] is not None: _timebar['vlist'].delete()
+        capacity = max(segments, 2*_timebar['capacity'], 64)
+        vl = shapes.get_default_shader().vertex_list(2*capacity, gl.GL_LINES, ui_batch,
+                                                     position='f', colors='Bn', translation='f',
+                                                     zposition='f', rotation='f')
+        for name in ('translation', 'zposition', 'rotation'):
+            np.ctypeslib.as_array(getattr(vl, name))[:] = 0
+        _timebar.update(vlist=vl, capacity=capacity)
+    return _timebar['vlist']
 
 def draw_timeintervals():
     global timebar_dirty
-    _clear_time_lines()
     xs = window.width // 5
     xe = window.width - xs
     xwidth = xe - xs
     ys = window.height // 15
     y = window.height - ys
     barheight = ys // 2
-    _time_box_lines.extend([
-        shapes.Line(xs, y, xe, y, thickness=1, batch=ui_batch),
-        shapes.Line(xs, y+barheight, xe, y+barheight, thickness=1, batch=ui_batch),
-        shapes.Line(xs, y, xs, y+barheight, thickness=1, batch=ui_batch),
-        shapes.Line(xe, y, xe, y+barheight, thickness=1, batch=ui_batch),
-    ])
-    for ln in _time_box_lines: ln.color = (252,77,51)
-    if timescale:
-        s = np.array(timescale)
-        last = s[-1]
-        for i in (s/last):
-            x_tick = xs + int(i * xwidth)
-            tln = shapes.Line(x_tick, y, x_tick, y+barheight, thickness=1, batch=ui_batch)
-            tln.color = (40,40,255)
-            _time_tick_lines.append(tln)
+    s = np.asarray(timescale, float)
+    k = kingman_times if kingman_times is not None else np.empty(0)
+    n = 4 + len(s) + len(k)
+    seg = np.empty((n, 2, 2))
+    col = np.empty((n, 4))
+    seg[:4] = (((xs, y), (xe, y)), ((xs, y+barheight), (xe, y+barheight)),
+               ((xs, y), (xs, y+barheight)), ((xe, y), (xe, y+barheight)))
+    col[:4] = BAR_COLOR
+    for ticks, top, color, at in ((s, barheight, TICK_COLOR, 4), (k, barheight//2, KINGMAN_COLOR, 4 + len(s))):
+        if not len(ticks): continue
+        x = xs + (ticks / ticks[-1] * xwidth).astype(int)
+        seg[at:at+len(ticks), :, 0] = x[:, None]
+        seg[at:at+len(ticks), 0, 1], seg[at:at+len(ticks), 1, 1] = y, y + top
+        col[at:at+len(ticks)] = color
+    vl = _timebar_vlist(n)
+    pos = np.ctypeslib.as_array(vl.position).reshape(-1, 2, 2)
+    pos[:n] = seg
+    colors = np.ctypeslib.as_array(vl.colors).reshape(-1, 2, 4)
+    colors[:n] = col[:, None, :]
+    colors[n:] = 0
     timebar_dirty = False
 
+# ---------------------------------------------------------------------
+# Genealogy panel: the growing tree beside the box, all branches in one
+# GL_LINES vertex list. Tips sit along the bottom ordered by the bugs' x
+# position at the start (neighbours tend to merge first); the m-th merge is
+# drawn at height m/(n-1) with a bar between its children and a stem up to
+# the top. A merge only writes its own three segments, nothing is laid out
+# again; the full rebuild runs on reset, resize and A/D.
+PANEL_FRACTION = 0.3
+TREE_COLOR = (120, 170, 255, 255)
+
+class GenealogyPanel:
+    def __init__(self):
+        self.visible = False
+        self.x = self.y = 0
+        self.width = self.height = 1
+        self.genealogy = None
+        self.capacity = 0
+        self._vlist = None
+
+    def _allocate(self, capacity):
+        # segments [0, capacity) are stems, [capacity, 2*capacity) bars, both by node id
+        if self._vlist is not None: self._vlist.delete()
+        self.capacity = capacity
+        self.seg = np.zeros((2*capacity, 2, 2))   # endpoints in panel units [0,1]
+        self.shown = np.zeros(2*capacity, bool)
+        self.xn = np.zeros(capacity)
+        program = shapes.get_default_shader()
+        self._vlist = vl = program.vertex_list(4*capacity, gl.GL_LINES, tree_batch,
+                                               position='f', colors='Bn', translation='f',
+                                               zposition='f', rotation='f')
+        np.ctypeslib.as_array(vl.zposition)[:] = 0
+        np.ctypeslib.as_array(vl.rotation)[:] = 0
+        np.ctypeslib.as_array(vl.translation).reshape(-1, 2)[:] = (self.x, self.y)
+
+    def reset(self, swarm):
+        g = self.genealogy = swarm.genealogy
+        if g is None: return
+        self.key = np.full(len(g.time), np.inf)
+        self.key[swarm.node] = swarm.pos[:, 0]
+        self.rebuild()
+
+    def rebuild(self):
+        g = self.genealogy
+        if g is None: return
+        if len(g.time) > self.capacity: self._allocate(len(g.time))
+        if len(self.key) < len(g.time):
+            self.key = np.concatenate((self.key, np.full(len(g.time) - len(self.key), np.inf)))
+        self.shown[:] = False
+        tips = g.tips
+        order = tips[np.lexsort((tips, self.key[tips]))]
+        self.xn[order] = (np.arange(len(order)) + 0.5) / max(1, len(order))
+        self.seg[tips, 0, 0] = self.seg[tips, 1, 0] = self.xn[tips]
+        self.seg[tips, 0, 1], self.seg[tips, 1, 1] = 0.0, 1.0
+        self.shown[tips] = True
+        self.step = 1.0 / max(1, len(tips) - 1)
+        self.rank = 0
+        for node in np.flatnonzero((g.left[:g.count] >= 0) & ~g.dropped[:g.count]):
+            self._merge(node)
+        self._upload(slice(None))
+
+    def _merge(self, node):
+        g, seg, xn = self.genealogy, self.seg, self.xn
+        a, b = g.left[node], g.right[node]
+        self.rank += 1
+        y = min(1.0, self.rank * self.step)
+        seg[a, 1, 1] = seg[b, 1, 1] = y
+        xn[node] = x = 0.5 * (xn[a] + xn[b])
+        bar = self.capacity + node
+        seg[bar] = ((xn[a], y), (xn[b], y))
+        seg[node] = ((x, y), (x, 1.0))
+        self.shown[bar] = self.shown[node] = True
+        return [a, b, bar, node]
+
+    def merged(self, node):
+        if self.genealogy is None: return
+        if node >= self.capacity: self.rebuild()
+        else: self._upload(self._merge(node))
+
+    def place(self, x, y, width, height):
+        self.x, self.y, self.width, self.height = x, y, max(1, width), max(1, height)
+        if self._vlist is None: return
+        np.ctypeslib.as_array(self._vlist.translation).reshape(-1, 2)[:] = (x, y)
+        self._upload(slice(None))
+
+    def _upload(self, idx):
+        vl = self._vlist
+        pos = np.ctypeslib.as_array(vl.position).reshape(-1, 2, 2)
+        pos[idx] = self.seg[idx] * (self.width, self.height)
+        col = np.ctypeslib.as_array(vl.colors).reshape(-1, 2, 4)
+        col[idx] = np.where(self.shown[idx, None, None], TREE_COLOR, 0)
+
+panel = GenealogyPanel()
+
 # ---------------------------------------------------------------------
 # Pseudo-fullscreen helpers (Cocoa, full frame)
 # --- PSEUDO-FULLSCREEN that uses Retina scale correctly (points -> pixels) ---
@@ -348,22 +867,68 @@ def exit_pseudo_fullscreen():
 
 # ---------------------------------------------------------------------
 # Events
+def set_demes(demes):
+    # deal the bugs round the new demes, each keeping its place relative to its box
+    old = population.boxes
+    population.demes = demes
+    population._sync_edges()
+    new = population.boxes
+    for s in (bugs, kids):
+        deme = np.arange(len(s)) % demes
+        bugsim.remap(s.pos, old[s.deme], new[deme])
+        s.deme = deme
+        _clear_walls(s)
+        s.publish()
+    sim.sweeps = [bugsim.SweepAndPrune() for _ in range(demes)]
+
+def _clear_walls(s):
+    # bugs that a new or refitted arena left inside a wall go to free space
+    if population.arena is not None:
+        population.arena.scatter(s.pos, population.box_of(s.deme), s.radius, rng)
+
 def _rescale_bugs(old_box, new_box):
-    ox, oy, ow, oh = old_box
-    nx, ny, nw, nh = new_box
-    if ow <= 0 or oh <= 0:
+    sim.slack = -math.inf       # the bugs jump: the next step searches
+    if old_box[2] <= 0 or old_box[3] <= 0:
         return
-    for b in bugs + kids:
-        rx = (b.x - ox) / ow
-        ry = (b.y - oy) / oh
-        b.x = nx + rx * nw
-        b.y = ny + ry * nh
+    for s in (bugs, kids):
+        bugsim.remap(s.pos, old_box, new_box)
+        _clear_walls(s)
+        s.publish()
+
+# Keys that only touch the window act at once. The others change what the
+# simulation thread works on and need sim.lock; they queue in sim.keys and
+# run as soon as the lock is free, retried by update(), so a slow step
+# never stalls drawing. The simulation thread holds back while keys wait.
+WINDOW_KEYS = (key.F, key.ESCAPE, key.H, key.Q)
 
 @window.event
 def on_key_press(symbol, modifiers):
+    if symbol in WINDOW_KEYS:
+        handle_key(symbol, modifiers)
+    else:
+        sim.keys.append((symbol, modifiers))
+        run_keys()
+    request_redraw()
+
+_in_keys = False
+
+def run_keys():
+    # not re-entered: R and Enter reach update() from inside handle_key()
+    global _in_keys
+    if _in_keys or not sim.keys or not sim.lock.acquire(blocking=False): return
+    _in_keys = True
+    try:
+        while sim.keys:
+            handle_key(*sim.keys.popleft())
+            sim.slack = -math.inf
+    finally:
+        _in_keys = False
+        sim.lock.release()
+
+def handle_key(symbol, modifiers):
     global current_img_index, masterscale
     global chasing, cycles_since_chasing, chaseMode, procreateMode, didProcreate
-    global timescale, starttime, helper, timebar_dirty
+    global timescale, starttime, helper, timebar_dirty, kingman_times, demography, brownian
 
     if symbol == key.F:
         if _fs_active: exit_pseudo_fullscreen()
@@ -375,49 +940,60 @@ def on_key_press(symbol, modifiers):
         helper = not helper
         helplabel.text = "" if not helper else displayhelp()
     elif symbol == key.SPACE:
-        population.update(GROW); timebar_dirty = True
+        old_box = population.box
+        population.update(GROW); _rescale_bugs(old_box, population.box)
     elif symbol == key.BACKSPACE:
-        population.update(SHRINK); timebar_dirty = True
+        old_box = population.box
+        population.update(SHRINK); _rescale_bugs(old_box, population.box)
     elif symbol == key.S:
-        masterscale = (bugs[0].sprite.scale if (bugs and bugs[0].is_sprite) else masterscale) * 0.9
-        for b in bugs: b.setscale(masterscale)
+        masterscale = (bugs.scale if len(bugs) else masterscale) * 0.9
+        bugs.setscale(masterscale)
     elif symbol == key.I:
-        masterscale = (bugs[0].sprite.scale if (bugs and bugs[0].is_sprite) else masterscale) * 1.1
-        for b in bugs: b.setscale(masterscale)
+        masterscale = (bugs.scale if len(bugs) else masterscale) * 1.1
+        bugs.setscale(masterscale)
     elif symbol == key.A:
-        img = IMAGES[current_img_index]
-        bugs.append(Bug(img))
+        bugs.add(1)
+        panel.rebuild()
         label2.text = 'k=' + str(len(bugs))
     elif symbol == key.D:
-        if bugs:
-            del bugs[-1]
+        if len(bugs):
+            bugs.remove(len(bugs)-1)
+            panel.rebuild()
             label2.text = 'k=' + str(len(bugs))
     elif symbol == key.ENTER:
         starttime = time.time()
-        population.start = not population.start
+        set_running(not population.start)
     elif symbol == key.R:
         current_img_index = random.randint(0, len(IMAGES)-1)
-        timescale.clear(); bugs.clear()
+        timescale.clear()
+        sim.events.clear()
+        governor.reset(); draw_governor.reset()
+        restart_schedule()
+        sim.migrants = 0
         sample = int(sys.argv[1]) if len(sys.argv) > 1 else 100
-        for _ in range(sample):
-            bugs.append(Bug(IMAGES[current_img_index]))
+        bugs.spawn(sample, IMAGES[current_img_index])
+        panel.reset(bugs)
         label2.text = 'k=' + str(sample)
         label3.text = "Time:%6i\nLast:%6i" % (0,0)
         starttime = time.time()
-        population.start = False
+        set_running(False)
         chasing = False; cycles_since_chasing = 0
         chaseMode = procreateMode = didProcreate = False
         timebar_dirty = True
     elif symbol == key.Z:
         current_img_index = len(IMAGES)-1
-        timescale.clear(); bugs.clear()
+        timescale.clear()
+        sim.events.clear()
+        governor.reset(); draw_governor.reset()
+        restart_schedule()
+        sim.migrants = 0
         sample = int(sys.argv[1]) if len(sys.argv) > 1 else 100
-        for _ in range(sample):
-            bugs.append(Bug(IMAGES[current_img_index]))
+        bugs.spawn(sample, IMAGES[current_img_index])
+        panel.reset(bugs)
         label2.text = 'k=' + str(sample)
         label3.text = "Time:%6i\nLast:%6i" % (0,0)
         starttime = time.time()
-        population.start = False
+        set_running(False)
         chasing = False; cycles_since_chasing = 0
         chaseMode = procreateMode = didProcreate = False
         timebar_dirty = True
@@ -425,19 +1001,79 @@ def on_key_press(symbol, modifiers):
         chaseMode = not chaseMode
     elif symbol == key.P:
         procreateMode = not procreateMode
+    elif symbol == key.W:
+        population.torus = not population.torus
+        population._sync_edges()
+        print(f"[info] boundary: {'torus' if population.torus else 'walls'}")
+    elif symbol == key.O:
+        population.arena_name = ARENAS[(ARENAS.index(population.arena_name) + 1) % len(ARENAS)]
+        population._sync_edges()
+        for s in (bugs, kids):
+            _clear_walls(s)
+            s.publish()
+    elif symbol == key.B:
+        brownian = not brownian
+        print(f"[info] movement: {'Brownian' if brownian else 'ballistic'}")
+    elif symbol == key.M and modifiers & key.MOD_SHIFT:
+        population.migration = MIGRATION[(MIGRATION.index(population.migration) + 1) % len(MIGRATION)]
+        print(f"[info] migration rate: {population.migration}")
+    elif symbol == key.M:
+        set_demes(DEMES[(DEMES.index(population.demes) + 1) % len(DEMES)])
+        print(f"[info] demes: {population.demes}")
+    elif symbol == key.N:
+        demography = bugsim.SCHEDULES[(bugsim.SCHEDULES.index(demography) + 1) % len(bugsim.SCHEDULES)]
+        print(f"[info] demographic schedule: {demography.name}")
+        # the clock runs on: only R and Z start time over, so merges stay
+        # younger than the lineages they join
+        old_box = population.box
+        population.set_size(float(demography.size(sim.clock)))
+        _rescale_bugs(old_box, population.box)
+    elif symbol == key.K:
+        n = len(bugs.genealogy.tips) if bugs.genealogy is not None else len(bugs)
+        kingman_times = bugsim.kingman(n, rng) if kingman_times is None and n > 1 else None
+        timebar_dirty = True
+    elif symbol == key.T:
+        panel.visible = not panel.visible
+        relayout(window.width, window.height)
+    elif symbol == key.G:
+        save_genealogy(GENEALOGY_FILE)
+    elif symbol == key.U:
+        population.mutation = MUTATION[(MUTATION.index(population.mutation) + 1) % len(MUTATION)]
+        print(f"[info] mutation rate: {population.mutation}")
+        if population.mutation: bugs.track_mutations()
+    elif symbol == key.X:
+        save_genotypes(GENOTYPE_FILE)
     elif symbol == key.Q:
-        sound.play()
+        sound.click()
+
+# a drag fires many resize events per frame; only the last size is laid out,
+# by the next on_draw()
+_resize_to = None
 
 @window.event
 def on_resize(width, height):
+    global _resize_to
+    _resize_to = (width, height)
+    request_redraw()
+
+@window.event
+def on_expose():
+    request_redraw()
+
+def relayout(width, height):
     global timebar_dirty
     old_box = (population.x, population.y, population.width, population.height)
 
     # center with 100px margins
     population.x = 100
     population.y = 100
-    population.width  = max(200, width  - 200)
+    panel_w = int(width * PANEL_FRACTION) if panel.visible else 0
+    population.width  = max(200, width  - 200 - panel_w)
     population.height = max(200, height - 200)
+    if panel.visible:
+        panel.place(population.x + population.width + 50, population.y, panel_w - 50, population.height)
+    size, population.size = population.size, 1.0
+    population.set_size(size)
     population._sync_edges()
 
     # rescale bug positions to preserve relative layout
@@ -447,6 +1083,7 @@ def on_resize(width, height):
     # labels
     label.x, label.y   = width // 2, 10
     label2.x, label2.y = width - width // 8, height - height // 15
+    label4.x, label4.y = label2.x, label2.y - 20
     label3.x, label3.y = width // 5, height - height // 20
     helplabel.x, helplabel.y = width // 5, height - height // 5
 
@@ -454,103 +1091,397 @@ def on_resize(width, height):
 
 @window.event
 def on_draw():
+    global _resize_to
+    t0 = time.perf_counter()
+    if _marks[-1][0] != 'first frame':
+        _marks.append(('first frame', time.perf_counter()))
+        startup_report()
+    if _resize_to is not None:
+        with sim.lock:
+            relayout(*_resize_to)
+        _resize_to = None
     window.clear()
     if timebar_dirty:
         draw_timeintervals()
     ui_batch.draw()
+    level = draw_governor.level
+    draw_governor.frames += 1
+    if level < 2 or draw_governor.frames % 2 == 0:
+        bugs.sync(blend=level < 1); kids.sync(blend=level < 1)
     sprite_batch.draw()
-    label.draw(); label2.draw(); label3.draw(); helplabel.draw()
+    if panel.visible: tree_batch.draw()
+    label.draw(); label2.draw(); label3.draw(); label4.draw(); helplabel.draw()
+    if population.start: draw_governor.measure(time.perf_counter() - t0, len(bugs))
 
 # ---------------------------------------------------------------------
 # Distance / coalescence
-def dist(a, b): return math.hypot(a.x - b.x, a.y - b.y)
-
-def distance(coords):
-    cc = np.array(coords); x = cc[:,0]; y = cc[:,1]
-    n = len(x)
-    d = np.zeros((n,n), dtype=float)
-    for i in range(n):
-        for j in range(i+1, n):
-            td = math.hypot(x[i]-x[j], y[i]-y[j])
-            d[i,j] = d[j,i] = td
-        d[i,i] = HUGE
-    return d
-
-def coalesce(sample, distance_mat, mindistance):
-    global starttime, timescale, elapsed, timebar_dirty
-    x = np.argmin(distance_mat, axis=None)
-    idx = np.unravel_index(x, distance_mat.shape)
-    if distance_mat[idx[0], idx[1]] < mindistance:
-        sound.play()
-        label2.text = "k: " + str(len(bugs) - 1)
-        t = time.time() - starttime
-        elapsed = int(t)
-        label3.text = "Time:%6i\nLast:%6i" % (elapsed, elapsed)
-        timescale.append(float(t))
-        timebar_dirty = True
-        return idx[1]
+def dist(a, b): return math.hypot(a[0] - b[0], a[1] - b[1])
+
+def pick_search(k, mindistance, box):
+    # the search calibrated fastest for this k and crowding (row blocks until
+    # the calibration is in)
+    if sim.table is None: return 'blocked'
+    return bugsim.pick_search(sim.table, k, bugsim.density(k, mindistance, box))
+
+def closest(coords, mindistance, deme):
+    # closest pair (i, j, d), i < j; with several demes only bugs of the same
+    # deme are compared, each deme with the search picked for its own k
+    if population.demes == 1:
+        groups, boxes = None, [population.box]
+        names = (pick_search(len(coords), mindistance, population.box),)
+    else:
+        groups, boxes = bugsim.demes_of(deme, population.demes), population.boxes
+        names = tuple(pick_search(len(g), mindistance, b) for g, b in zip(groups, boxes))
+    if names != sim.search:
+        k = len(coords) if groups is None else [len(g) for g in groups]
+        print(f"[info] contact search at k={k}: {', '.join(names)}")
+        sim.search = names
+    # sweep-and-prune keeps each deme's x order between steps
+    searches = [sim.sweeps[d] if name == 'sweep' else bugsim.SEARCH[name] for d, name in enumerate(names)]
+    if groups is None:
+        return searches[0](coords, mindistance, SEARCH_THREADS, population.period)
+    return bugsim.closest_in_demes(coords, groups, searches, mindistance, SEARCH_THREADS, population.period)
+
+def coalesce(sample, pair, mindistance):
+    # simulation thread: record the merge and queue it for the render thread
+    i, j, d = pair
+    if d < mindistance:
+        t = sim.clock     # simulated seconds: pauses leave no gaps in the tree
+        node = -1
+        if j < len(sample):
+            sample.record_merge(i, j, t)
+            if sample is bugs: node = sample.node[i]
+        sim.events.append((t, node))
+        return j
     return -1
 
-def update(dt):
+def save_genealogy(path):
+    if bugs.genealogy is None: return
+    with open(path, 'w') as fh:
+        bugs.genealogy.write_newick(fh)
+    print(f"[info] genealogy of {len(bugs.genealogy.tips)} bugs written to {path}")
+
+def save_genotypes(path):
+    if bugs.mutations is None: return
+    bugs.mutations.save(path)
+    print(f"[info] {len(bugs.mutations)} sites x {bugs.mutations.sample} bugs written to {path}")
+
+# ---------------------------------------------------------------------
+# Time budgets: a step may take one simulation period, a frame one redraw
+# period. After OVERRUNS in a row over budget a governor drops one level of
+# its quality ladder; it climbs back once the work fits in half the budget
+# again and k has fallen to RECOVER of what it was when that level was
+# given up. Every change is logged, and kept in history as (time, k, level)
+# so degraded runs can be flagged. The step governor, timed on the
+# simulation thread, skips the contact search on steps where no pair can
+# have come within mindistance (see step()), which leaves the results as
+# they are. The draw governor, timed in on_draw, cuts render work.
+STEP_QUALITY = ('search every step', 'search when a contact is possible')
+DRAW_QUALITY = ('full drawing', 'no blending', 'half-rate drawing')
+OVERRUNS, RECOVER = 3, 0.7
+
+class Governor:
+    def __init__(self, budget, quality):
+        self.budget = budget
+        self.quality = quality
+        self.level = 0
+        self.frames = 0
+        self.late = 0
+        self.k_at = [0] * len(quality)
+        self.history = []
+
+    def measure(self, seconds, k):
+        if seconds > self.budget:
+            self.late += 1
+            if self.late >= OVERRUNS and self.level < len(self.quality) - 1:
+                self.k_at[self.level] = k
+                self._set(self.level + 1, k, "%.0f ms > %.0f ms" % (1e3*seconds, 1e3*self.budget))
+        else:
+            self.late = 0
+            if self.level and seconds < 0.5 * self.budget and k <= RECOVER * self.k_at[self.level - 1]:
+                self._set(self.level - 1, k, "back in budget")
+
+    def _set(self, level, k, why):
+        self.level, self.late = level, 0
+        self.history.append((time.time() - starttime, k, level))
+        print(f"[info] {why} at k={k}: {self.quality[level]}")
+
+    def reset(self):
+        if self.level: self._set(0, len(bugs), "reset")
+        self.history.clear()
+
+    @property
+    def text(self): return "degraded: " + self.quality[self.level] if self.level else ""
+
+governor = Governor(1.0 / SIM_RATE, STEP_QUALITY)
+draw_governor = Governor(1.0 / FRAME_RATE, DRAW_QUALITY)
+
+# ---------------------------------------------------------------------
+# Simulation thread: steps the swarms at SIM_RATE into their back buffers
+# under sim.lock (key and resize handlers take the same lock), so a slow
+# step never holds up drawing or input. Merges come back as (time, node)
+# events that update() turns into sound, labels, time bar and tree.
+class Simulation(threading.Thread):
+    def __init__(self, rate):
+        super().__init__(daemon=True)
+        self.dt = 1.0 / rate
+        self.slack = -math.inf            # lower bound on closest distance - mindistance, see step()
+        self.lock = threading.RLock()
+        self.events = collections.deque()
+        self.table, self.search = None, ('blocked',)
+        self.sweeps = [bugsim.SweepAndPrune()]    # one per deme, see closest()
+        self.migrants = 0
+        self.clock = 0.0                  # simulated seconds: schedule, merge and mutation times
+        self.wake = threading.Event()     # set while population.start
+        self.keys = collections.deque()   # key presses waiting for the lock, see on_key_press
+        self.failure = None               # what stopped the run, shown until the next start
+        self.stopped = False              # the run stopped itself; update() tidies up
+
+    def calibrate(self):
+        self.table = bugsim.search_table(SEARCH_CACHE, bugsim.make_rng(), SEARCH_THREADS)
+
+    def run(self):
+        threading.Thread(target=self.calibrate, daemon=True).start()
+        due = time.perf_counter()
+        while True:
+            if not population.start:
+                self.wake.wait()
+                due = time.perf_counter()
+            while self.keys and population.start:
+                time.sleep(0.002)          # the render thread takes the lock for them
+            with self.lock:
+                if population.start:
+                    t0 = time.perf_counter()
+                    try:
+                        step(self.dt)
+                    except Exception as e:
+                        # a dead thread would leave the window showing a frozen
+                        # box: stop the run instead and say why
+                        traceback.print_exc()
+                        self.failure = f"stopped: {type(e).__name__}: {str(e)[:60]}"
+                        population.start = False
+                        self.wake.clear()
+                        self.stopped = True
+                        continue
+                    governor.measure(time.perf_counter() - t0, len(bugs))
+            due += self.dt
+            wait = due - time.perf_counter()
+            if wait > 0: time.sleep(wait)
+            else: due = time.perf_counter()    # behind: drop the backlog, never catch up
+
+sim = Simulation(SIM_RATE)
+
+def restart_schedule():
+    sim.clock = 0.0
+    population.set_size(float(demography.size(0.0)))
+
+def step(dt):
     global chasing, cycles_since_chasing, cycles_to_chase, chaseMode, procreateMode, didProcreate
     if population.start:
-        tim = int(time.time() - starttime)
-        label3.text = "Time:%6i\nLast:%6i" % (tim, int(elapsed))
-        coords = [b.update(dt) for b in bugs] + [k.update(dt) for k in kids]
-        if len(coords) > 1 and bugs:
-            dd = distance(coords)
-            mindistance = masterscale * (bugs[0].width + bugs[0].height) / 2.0
+        sim.clock += dt
+        size = float(demography.size(sim.clock))
+        if size != population.size:
+            old_box = population.box
+            population.set_size(size)
+            _rescale_bugs(old_box, population.box)
+        skip = governor.level and not (chaseMode or procreateMode)
+        if skip: before = np.concatenate((bugs.pos, kids.pos))
+        if population.demes > 1:
+            migrants = len(bugsim.migrate(bugs.pos, bugs.deme, population.boxes, population.migration, dt, rng))
+            sim.migrants += migrants
+            if migrants: sim.slack = -math.inf
+        coords = np.concatenate((bugs.update(dt), kids.update(dt)))
+        deme = np.concatenate((bugs.deme, kids.deme))
+        if bugs.mutations is not None and population.mutation:
+            bugs.mutations.mutate(bugs.slot, population.mutation, dt, sim.clock, rng)
+        if len(coords) > 1 and len(bugs):
+            mindistance = masterscale * (bugs.width + bugs.height) / 2.0
+            if skip and len(before) == len(coords):
+                # no two bugs got closer than twice the longest move of the
+                # step, so while the slack lasts no pair can touch and the
+                # search is skipped; a search looks that much further out
+                d = before - coords
+                if population.torus:
+                    for axis in (0, 1): bugsim.min_image(d[:, axis], population.period[axis])
+                reach = 2.0 * math.sqrt(float((d * d).sum(1).max()))
+                sim.slack -= reach
+                if sim.slack >= 0:
+                    pair = (0, 0, math.inf)
+                else:
+                    pair = closest(coords, mindistance + reach, deme)
+                    sim.slack = min(pair[2], mindistance + reach) - mindistance
+            else:
+                sim.slack = -math.inf
+                pair = closest(coords, mindistance, deme)
             if not chaseMode and not procreateMode:
-                idx = coalesce(bugs, dd, mindistance)
+                idx = coalesce(bugs, pair, mindistance)
             else:
                 if len(bugs) == 2:
                     if chasing:
                         cycles_since_chasing += 1
                         if cycles_since_chasing == cycles_to_chase:
                             chasing = False
-                            bugs[0].turn(-0.5*math.pi, 0.5*math.pi)
-                    if dd[0,1] < mindistance:
+                            bugs.turn(0, -0.5*math.pi, 0.5*math.pi)
+                    d01 = dist(coords[0], coords[1])
+                    if d01 < mindistance:
                         if procreateMode:
                             didProcreate = True
-                            kid = Bug(IMAGES[current_img_index])
-                            kids.append(kid)
+                            if kids.img is not IMAGES[current_img_index]:
+                                kids.set_image(IMAGES[current_img_index])
+                            kids.add(1)
                             chasing = False
-                            kid.setscale(0.4*masterscale)
-                            kid.x, kid.y = bugs[0].x, bugs[0].y
-                            coords.append(kid.update(dt))
-                            dd = distance(coords)
+                            kids.setscale(0.4*masterscale)
+                            kids.pos[-1] = bugs.pos[0]
+                            kids.deme[-1] = bugs.deme[0]
+                            kids.update(dt)
                             time.sleep(0.2)
                             return
                         else:
-                            bugs[0].turn(-0.5*math.pi, 0.5*math.pi)
-                            bugs[1].x, bugs[1].y = bugs[0].x, bugs[0].y
-                            bugs[1].dx = bugs[1].dy = 0
-                            while dd[0,1] < 1.5*mindistance:
-                                bugs[0].update(dt)
-                                dd[0,1] = dd[1,0] = dist(bugs[0], bugs[1])
+                            bugs.turn(0, -0.5*math.pi, 0.5*math.pi)
+                            bugs.pos[1] = bugs.pos[0]
+                            bugs.deme[1] = bugs.deme[0]
+                            bugs.vel[1] = 0
+                            while d01 < 1.5*mindistance:
+                                bugs.update(dt, slice(0, 1))
+                                d01 = dist(bugs.pos[0], bugs.pos[1])
+                            pair = closest(np.concatenate((bugs.pos, kids.pos)), mindistance,
+                                           np.concatenate((bugs.deme, kids.deme)))
                             chasing = True
                             cycles_since_chasing = 0
-                            bugs[1].dx, bugs[1].dy = bugs[0].dx, bugs[0].dy
-                            for b in bugs:
-                                b.dx *= 2; b.dy *= 2
+                            bugs.vel[1] = bugs.vel[0]
+                            bugs.vel *= 2
                             cycles_to_chase = random.randint(5,25)
-                idx = -1 if (procreateMode and didProcreate) else coalesce(bugs, dd, mindistance)
+                idx = -1 if (procreateMode and didProcreate) else coalesce(bugs, pair, mindistance)
             if idx >= 0:
-                del bugs[idx]
+                # the swallowed bug leaves its deme's sweep order in place
+                d = deme[idx]
+                sim.sweeps[d].remove(int(np.count_nonzero(deme[:idx] == d)))
+                bugs.delete(idx)
+
+def update(dt):
+    # render thread: report what the simulation thread did since the last tick
+    global elapsed, timebar_dirty
+    run_keys()
+    if sim.stopped:
+        sim.stopped = False
+        set_running(False)
+    merges = 0
+    while sim.events:
+        t, node = sim.events.popleft()
+        merges += 1
+        if node >= 0: panel.merged(node)
+        elapsed = int(t)
+        timescale.append(float(t))
+        timebar_dirty = True
+        label2.text = "k: " + str(len(bugs))
+    if merges: sound.click(merges)
+    if population.start:
+        label3.text = "Time:%6i\nLast:%6i" % (sim.clock, int(elapsed))
+        if demography.name != 'constant':
+            label3.text += "\nNe:%8.2f %s" % (population.size, demography.name)
+        if population.demes > 1:
+            label3.text += "\nDemes:%4i m=%g\nMigrants:%6i" % (population.demes, population.migration, sim.migrants)
+        if bugs.mutations is not None and (population.mutation or len(bugs.mutations)):
+            label3.text += "\nSites:%7i\nthetaW:%8.2f" % (len(bugs.mutations), bugs.mutations.watterson)
+    if population.moved:
+        population.moved = False
+        population._sync_edges()
+    text = "\n".join(t for t in (sim.failure, governor.text, draw_governor.text) if t)
+    if label4.text != text: label4.text = text
+
+# ---------------------------------------------------------------------
+# Scheduling: the window is redrawn only from here (pyglet.app.run(None)).
+# While the bugs run, update() and redraw() tick on the clock; paused, both
+# are unscheduled, the simulation thread sleeps on sim.wake, and a frame is
+# drawn only after a key, resize or expose, so an idle window costs nothing.
+_redraw_pending = False
+
+def redraw(dt=0.0):
+    global _redraw_pending
+    _redraw_pending = False
+    window.draw(dt)
+
+def request_redraw(delay=0.0):
+    global _redraw_pending
+    if population.start or _redraw_pending: return
+    _redraw_pending = True
+    pyglet.clock.schedule_once(redraw, delay)
+
+def attach_assets(dt=0.0):
+    global _sound_job
+    for i, job in enumerate(_image_jobs):
+        if job is None or not job.done(): continue
+        _image_jobs[i] = None
+        IMAGES[i] = job.result()
+        if i == current_img_index and IMAGES[i] is not None:
+            with sim.lock:
+                for s in (bugs, kids): s.set_image(IMAGES[i])
+            request_redraw()
+    if _sound_job is not None and _sound_job.done():
+        sound.attach(_sound_job.result())
+        _sound_job = None
+    if _sound_job is None and not any(_image_jobs):
+        pyglet.clock.unschedule(attach_assets)
+        _loader.shutdown(wait=False)
+
+def attach_field(dt=0.0):
+    # render thread: once the pool has the field, refit the arena, which now
+    # finds it in the cache
+    job = population._field_job
+    if job is None or not job[1].done(): return
+    pyglet.clock.unschedule(attach_field)
+    population._field_job = None
+    job[1].result()
+    with sim.lock:
+        sim.slack = -math.inf
+        population._fit_arena(population.boxes)
+        for s in (bugs, kids):
+            _clear_walls(s)
+            s.publish()
+    request_redraw()
+
+def set_running(on):
+    global _redraw_pending
+    population.start = on
+    pyglet.clock.unschedule(update)
+    pyglet.clock.unschedule(redraw)
+    _redraw_pending = False
+    if on:
+        sim.failure = None
+        sim.wake.set()
+        pyglet.clock.schedule_interval(update, 1/30.0)
+        pyglet.clock.schedule_interval(redraw, 1/FRAME_RATE)
+    else:
+        sim.wake.clear()
+        update(0.0)
+        request_redraw(sim.dt)    # once the last step has blended in
 
 # ---------------------------------------------------------------------
 # Init
-bugs, kids, timescale = [], [], []
+timescale = []
+bugs = Swarm(IMAGES[current_img_index], masterscale, record=True)
+kids = Swarm(IMAGES[current_img_index], 0.4*masterscale)
 starttime = time.time()
 sample = int(sys.argv[1]) if len(sys.argv) > 1 else 100
-for _ in range(sample):
-    bugs.append(Bug(IMAGES[current_img_index]))
+bugs.spawn(sample, IMAGES[current_img_index])
+panel.reset(bugs)
 label2.text = "k: " + str(len(bugs))
 
 # Build UI once
 draw_timeintervals()
+_marks.append(('labels, panel, %d bugs' % len(bugs), time.perf_counter()))
+
+# BUGSINBOX_STARTUP=1 prints how long each stage up to the first frame took;
+# python -X importtime has the full import tree
+def startup_report():
+    if not os.environ.get('BUGSINBOX_STARTUP'): return
+    print("startup       ms   total")
+    for (_, last), (what, t) in zip(_marks, _marks[1:]):
+        print("  %8.1f %8.1f  %s" % (1e3*(t - last), 1e3*(t - _marks[0][1]), what))
 
-pyglet.clock.schedule_interval(update, 1/30.0)
+sim.start()
+set_running(False)
+pyglet.clock.schedule_interval(attach_assets, 1/20.0)
 
 if __name__ == '__main__':
-    pyglet.app.run()
+    pyglet.app.run(None)
@@ -47,16 +47,21 @@
     is the equivalent of the effective population size.
     '''
 
+import time
+_t0 = time.perf_counter()
 import os
 import random
 import sys
-from numpy import *
+import math
+from math import pi
 
 import pyglet
-from pyglet.gl import *
+_import_pyglet = time.perf_counter()
+from pyglet import gl
 from pyglet.window import key
-import time
-import math
+_import_gl = time.perf_counter()
+# numpy is only needed once the bugs move: distance() and coalesce() import
+# it, and populate() warms it up on a thread after the first frame
 
 # what is my directory?
 currentdir = os.getcwd()
@@ -97,9 +102,27 @@ didProcreate = False
 if len(sys.argv) > 2:
     BALL_SOUND = sys.argv[2]
 
-sound = pyglet.resource.media(BALL_SOUND, streaming=False)
+sound = None    # loaded by populate() after the first frame
 #music = pyglet.resource.media(BALL_SOUND2)
 myimage = BALL_IMAGE
+
+#
+# startup report: BUGSINBOX_STARTUP=1 prints when each stage was reached;
+# for the full import tree run  python -X importtime bugsinbox.py
+#
+_marks = [('python + os, random, math', _t0), ('import pyglet', _import_pyglet),
+          ('import pyglet.gl, pyglet.window', _import_gl)]
+def mark(what):
+    _marks.append((what, time.perf_counter()))
+
+def startup_report():
+    if not os.environ.get('BUGSINBOX_STARTUP'):
+        return
+    last = _t0
+    print("startup       ms   total")
+    for what, t in _marks:
+        print("  %8.1f %8.1f  %s" % (1e3*(t - last), 1e3*(t - _t0), what))
+        last = t
 #
 # used to calculate the speed of the bugs
 #
@@ -136,10 +159,17 @@ class Population():
     # update the box
     #
     def update(self,growvalue):
+        ox, oy, ow, oh = self.x, self.y, self.width, self.height
         self.width = self.width + growvalue
         self.height = self.height + growvalue
         self.x = self.x - growvalue//2
         self.y = self.y - growvalue//2
+        # the bugs keep their place relative to the box: one affine map,
+        # its factors worked out once
+        sx = float(self.width) / ow
+        sy = float(self.height) / oh
+        for ball in balls + kids:
+            ball.position = (self.x + (ball.x - ox) * sx, self.y + (ball.y - oy) * sy)
 
 
 ##################################################
@@ -148,15 +178,26 @@ class Population():
 class Ball(pyglet.sprite.Sprite):
     global didProcreate
     global myimage
-    ball_image = pyglet.resource.image(myimage)
-    #ball_image = pyglet.image.load(myimage)
-    ball_image.anchor_x = ball_image.width/2
-    ball_image.anchor_y = ball_image.height/2
-    width = ball_image.width
-    height = ball_image.height
+    ball_image = None
+    width = 0
+    height = 0
+
+    # decode the bug image once, when the first bug is made
+    #
+    @classmethod
+    def load(cls):
+        if cls.ball_image is None:
+            cls.ball_image = pyglet.resource.image(myimage)
+            #ball_image = pyglet.image.load(myimage)
+            cls.ball_image.anchor_x = cls.ball_image.width/2
+            cls.ball_image.anchor_y = cls.ball_image.height/2
+            cls.width = cls.ball_image.width
+            cls.height = cls.ball_image.height
+
     # create a bug
     #
     def __init__(self):
+        self.load()
         radius = masterscale * (self.width + self.height)/4
         x0 = population.x + radius/2
         y0 = population.y + radius/2
@@ -221,12 +262,6 @@ class Ball(pyglet.sprite.Sprite):
         #self.height = self.ball_image.height
         self.scale = masterscale
 
-# define the windows size, if you want to have a regular window then
-# uncomment the next line and comment out the other one
-#window = pyglet.window.Window(800, 600)
-window = pyglet.window.Window(fullscreen=False)
-population = Population(window)
-
 #
 #  Display the menu
 #
@@ -256,7 +291,6 @@ def displayhelp():
 #
 # on any window event (mouse or key press run this function)
 #
-@window.event
 def on_key_press(symbol, modifiers):
     global myimage
     global imagelist
@@ -295,7 +329,7 @@ def on_key_press(symbol, modifiers):
         starttime = time.time()
         population.start = not(population.start)
     elif symbol == key.R:
-        myimage = imagelist[random.randint(0,3)]
+        myimage = imagelist[random.randint(0,2)]
         if timescale:
             del timescale[:]
         if balls:
@@ -361,7 +395,6 @@ def on_key_press(symbol, modifiers):
 #
 # on any event try to draw all bugs and labels
 #
-@window.event
 def on_draw():
     window.clear()
     population.draw()
@@ -371,6 +404,8 @@ def on_draw():
     label3.draw()
     helplabel.draw()
     draw_timeintervals()
+    if not balls and _populating:
+        _first_frame()
 
 
 #
@@ -436,7 +471,7 @@ def update(dt):
                             for ball in balls:
                                 ball.dx = ball.dx * 2
                                 ball.dy = ball.dy * 2
-                            cycles_to_chase = random.randint(5, 25)
+                            cycles_to_chase = random.randint(5, 24)
                 if procreateMode and didProcreate:
                     id = -1     # prevent deletion
                 else:
@@ -458,10 +493,11 @@ def dist(a, b):
 # calculate the distance between bugs
 #
 def distance(c):
-    cc = array(c)
+    import numpy as np
+    cc = np.array(c)
     x = cc[:,0]
     y = cc[:,1]
-    d = array(zeros((len(x),len(x)), dtype=float))
+    d = np.zeros((len(x),len(x)), dtype=float)
     for i in range(0,len(x)):
         for j in range(i+1,len(x)):
             d1 = x[i] - x[j]
@@ -479,9 +515,10 @@ def coalesce(sample,distance,mindistance):
     global starttime
     global timescale
     global elapsed
-    x = argmin(distance, axis=None)
+    import numpy as np
+    x = np.argmin(distance, axis=None)
     dims = distance.shape
-    idx = unravel_index(x, dims)
+    idx = np.unravel_index(x, dims)
     if(distance[idx[0],idx[1]]<mindistance):
         #delete(sample,idx[1],0)
         sound.play()
@@ -497,14 +534,14 @@ def coalesce(sample,distance,mindistance):
 # basic routine to draw a rectangle for the timeintervals
 #
 def draw_rect(x, y, width, height):
-    glBegin(GL_LINE_LOOP)
+    gl.glBegin(gl.GL_LINE_LOOP)
     #glBegin(GL_TRIANGLES)
-    glColor4f(0.99, 0.3, 0.2, 1.0)
-    glVertex2f(x, y)
-    glVertex2f(x + width, y)
-    glVertex2f(x + width, y + height)
-    glVertex2f(x, y + height)
-    glEnd()
+    gl.glColor4f(0.99, 0.3, 0.2, 1.0)
+    gl.glVertex2f(x, y)
+    gl.glVertex2f(x + width, y)
+    gl.glVertex2f(x + width, y + height)
+    gl.glVertex2f(x, y + height)
+    gl.glEnd()
     #glBegin(GL_TRIANGLES)
     #glColor4f(0.2, 0.3, 0.2, 1.0)
     #glVertex2f(x, y)
@@ -525,54 +562,78 @@ def draw_timeintervals():
     xwidth = xe - xs
     ys = window.height // 15
     y = window.height - ys
-    s = array(timescale)
     barheight = ys // 2
     draw_rect(xs,y,xwidth,barheight)
-    if len(s) > 0:
-        sss = s[-1]
-        ss =  sss * ones(len(s), float)
-        timescale_adj = s / ss
-        #        print ss,timescale_adj
-        for i in timescale_adj:
-            draw_rect(xs+i*xwidth, y, 1, barheight)
+    if timescale:
+        last = timescale[-1]
+        for t in timescale:
+            draw_rect(xs+t/last*xwidth, y, 1, barheight)
 
 ###############################################
-# set up the speed of the update event
-# and define things and finally run
-# the application
+# set up the window, labels and clock; the bugs, their image and the sound
+# come in populate() once the first (empty) frame is on screen, so nothing
+# heavy happens at import and the window shows up at once
 #
-pyglet.clock.schedule_interval(update, 1/30.)
-
-balls_batch = pyglet.graphics.Batch()
-balls = []
-kids = []
-starttime = time.time()
-timescale=[]
-
-
-if len(sys.argv) > 1:
-    for i in range(0,int(sys.argv[1])):
-        balls.append(Ball())
-else:
-    for i in range(0,int(100)):
+_populating = False
+
+def _first_frame():
+    global _populating
+    _populating = False
+    mark('first frame')
+    pyglet.clock.schedule_once(populate, 0)
+
+def populate(dt=0):
+    global sound
+    import threading
+    sound = pyglet.resource.media(BALL_SOUND, streaming=False)
+    if len(sys.argv) > 1:
+        sample = int(sys.argv[1])
+    else:
+        sample = 100
+    for i in range(0,sample):
         balls.append(Ball())
-
-label = pyglet.text.Label('Press H for the help menu',
-                          font_size=12                     ,
-                          x=window.width // 2, y=10,
-                          anchor_x='center')
-label2 = pyglet.text.Label("k: "+str(len(balls)),
-                           font_size=12,
-                           x=window.width - window.width // 8, y=window.height - window.height // 15,
-                           anchor_x='center')
-label3 = pyglet.text.Label("Time: "+str(0),
-                           font_size=12,multiline=True,width=200,
-                           x=window.width // 5, y=window.height - window.height // 20,
-                           anchor_x='center')
-helplabel = pyglet.text.Label("",
-                              font_size=12,multiline=True,width=800,
-                              x=window.width // 5, y=window.height - window.height // 5,
-                              anchor_x='left')
+    label2.text = "k: "+str(len(balls))
+    mark('%d bugs and sound' % sample)
+    startup_report()
+    threading.Thread(target=__import__, args=('numpy',), daemon=True).start()
+
+def main():
+    global window, population, balls_batch, balls, kids, starttime, timescale
+    global label, label2, label3, helplabel, _populating
+    # define the windows size, if you want to have a regular window then
+    # uncomment the next line and comment out the other one
+    #window = pyglet.window.Window(800, 600)
+    window = pyglet.window.Window(fullscreen=False)
+    window.push_handlers(on_key_press, on_draw)
+    population = Population(window)
+    mark('window')
+
+    pyglet.clock.schedule_interval(update, 1/30.)
+
+    balls_batch = pyglet.graphics.Batch()
+    balls = []
+    kids = []
+    starttime = time.time()
+    timescale=[]
+
+    label = pyglet.text.Label('Press H for the help menu',
+                              font_size=12                     ,
+                              x=window.width // 2, y=10,
+                              anchor_x='center')
+    label2 = pyglet.text.Label("k: 0",
+                               font_size=12,
+                               x=window.width - window.width // 8, y=window.height - window.height // 15,
+                               anchor_x='center')
+    label3 = pyglet.text.Label("Time: "+str(0),
+                               font_size=12,multiline=True,width=200,
+                               x=window.width // 5, y=window.height - window.height // 20,
+                               anchor_x='center')
+    helplabel = pyglet.text.Label("",
+                                  font_size=12,multiline=True,width=800,
+                                  x=window.width // 5, y=window.height - window.height // 5,
+                                  anchor_x='left')
+    _populating = True
+    pyglet.app.run()
 
 if __name__ == '__main__':
-    pyglet.app.run()
+    main()